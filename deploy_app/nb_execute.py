@@ -0,0 +1,21 @@
+"""Notebook execution entry point for worker processes.
+
+Kept out of streamlit_app.py: Streamlit re-executes that script as ``__main__``
+on every rerun, so its functions cannot be pickled by reference into a
+ProcessPoolExecutor, whereas this module is importable by name.
+"""
+
+from __future__ import annotations
+
+
+def execute_notebook(nb_bytes: bytes, cwd: str) -> bytes:
+    """Execute a notebook in a fresh kernel and return the executed notebook as JSON bytes."""
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    # Read and write without schema validation; the app's exporter validates once
+    node = nbformat.convert(nbformat.reader.reads(nb_bytes.decode("utf-8")), 4)
+    kernel_name = (node.metadata.get("kernelspec") or {}).get("name") or "python3"
+    ep = ExecutePreprocessor(timeout=300, kernel_name=kernel_name)
+    ep.preprocess(node, {"metadata": {"path": cwd}})
+    return nbformat.v4.writes(node).encode("utf-8")
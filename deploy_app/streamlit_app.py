@@ -1,22 +1,74 @@
 from __future__ import annotations
 
+import base64
+import functools
+import hashlib
 import json
+import os
+import re
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from html import escape
+from io import BytesIO, StringIO
 from pathlib import Path
-from typing import List, Tuple, Dict
+from types import MappingProxyType
+from typing import Any, List, Mapping, Optional, Tuple, Dict
 
 import streamlit as st
 import requests
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from nb_execute import execute_notebook
 
+
+@functools.lru_cache(maxsize=1)
 def app_root() -> Path:
     return Path(__file__).resolve().parent
 
 
+@st.cache_resource(show_spinner=False)
+def _open_disk_cache() -> Cache:
+    """Return the on-disk cache shared by every rerun and session of this process."""
+    return Cache(str(Path.home() / ".cache" / "dsh-notebooks"), size_limit=500 * 1024 * 1024)
+
+
+_cache = _open_disk_cache()
+
+_SHA_RE = re.compile(r"[0-9a-f]{40}")
+
+# Lifetime of stored ETag/body pairs; each 304 revalidation extends it
+_ETAG_TTL = 7 * 24 * 3600
+
+# Case-insensitive tag lookup without materializing a lowercased copy of the HTML
+_HEAD_TAG_RE = re.compile(r"<head(?:\s[^>]*)?>", re.IGNORECASE)
+_HTML_TAG_RE = re.compile(r"<html(?:\s[^>]*)?>", re.IGNORECASE)
+
+# Above this much inline PNG data, large images are downsampled before export
+_IMAGE_BUDGET_BYTES = 2 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def _http_session() -> requests.Session:
+    """Return a process-wide session so TCP/TLS connections are pooled across calls."""
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
+    return session
+
+
 def main() -> None:
     st.set_page_config(page_title="Data Science Handbook - Viewer", layout="wide")
     st.title("Python Data Science Handbook - Notebooks Viewer")
 
     execute = st.checkbox("Exécuter avant rendu", value=False)
+    progressive = execute and st.checkbox(
+        "Affichage progressif pendant l'exécution",
+        value=False,
+        help="Affiche chaque cellule dès qu'elle est exécutée, avant le rendu HTML complet.",
+    )
     height = st.number_input("Hauteur (px)", min_value=400, max_value=2000, value=900, step=50)
     apply_css = st.checkbox("Appliquer style personnalisé", value=True)
     default_css = (
@@ -38,126 +90,553 @@ def main() -> None:
     )
     css_text = st.text_area("CSS", value=default_css, height=180) if apply_css else ""
 
-    # Unique source avec priorité GitHub, fallback local
-    owner = st.text_input("Owner", value="michaelgermini")
-    repo = st.text_input("Repo", value="PythonDataScienceHandbook")
-    branch = st.text_input("Branche", value="master")
-    directory = st.text_input("Dossier", value="notebooks")
-    query = st.text_input("Filtre (contient)", value="")
-
-    used_source = "github"
-    files: List[str] = []
-    with st.spinner("Chargement de la liste des notebooks…"):
-        ok, files = list_ipynb_from_github(owner, repo, branch, directory)
-    if (not ok) or (not files):
-        # Fallback local
-        used_source = "local"
-        notebooks_dir = app_root() / "notebooks"
-        local_files = [
-            str(p.relative_to(notebooks_dir))
-            for p in sorted(notebooks_dir.rglob("*.ipynb"))
-            if ".ipynb_checkpoints" not in str(p)
-        ] if notebooks_dir.exists() else []
-        files = local_files
+    with st.sidebar:
+        if st.button("Vider le cache"):
+            _cached_list.clear()
+            _cache.evict("gh-list")
+            st.session_state.pop("files", None)
+        if st.button("Vider le cache de rendu"):
+            st.cache_data.clear()
+            _cache.evict("html")
+
+    # Unique source avec priorité GitHub, fallback local.
+    # Batched in a form so typing does not rerun the script on every keystroke.
+    with st.form("github_form"):
+        owner = st.text_input("Owner", value="michaelgermini")
+        repo = st.text_input("Repo", value="PythonDataScienceHandbook")
+        branch = st.text_input("Branche", value="master")
+        directory = st.text_input("Dossier", value="notebooks")
+        query = st.text_input("Filtre (contient)", value="")
+        submitted = st.form_submit_button("Charger la liste")
+
+    if submitted or "files" not in st.session_state:
+        used_source = "github"
+        files: List[str] = []
+        blob_shas: Dict[str, str] = {}
+        ok, listing = list_ipynb_from_github(owner, repo, branch, directory)
+        if ok:
+            blob_shas = listing
+            files = list(listing)
+        if not files:
+            # Fallback local
+            used_source = "local"
+            files = _list_local(app_root() / "notebooks")
+        st.session_state["files"] = files
+        st.session_state["blob_shas"] = blob_shas
+        st.session_state["used_source"] = used_source
+    files = st.session_state["files"]
+    blob_shas = st.session_state["blob_shas"]
+    used_source = st.session_state["used_source"]
 
     if query:
         q = query.lower()
         files = [f for f in files if q in f.lower()]
 
+    if used_source == "github" and files:
+        with st.sidebar:
+            if st.button("Précharger tous"):
+                with st.spinner("Préchargement des notebooks…"):
+                    count = _prefetch_notebooks(owner, repo, branch, files)
+                st.success(f"{count} notebook(s) préchargé(s).")
+
     if not files:
         st.warning("Aucun notebook .ipynb trouvé.")
         return
 
     st.caption(f"Source utilisée: {'GitHub' if used_source=='github' else 'Local deploy_app/notebooks'}")
     selected = st.selectbox("Notebook", files)
-    if st.button("Convertir et afficher"):
-        if used_source == "github":
-            with st.spinner("Téléchargement et conversion…"):
-                ok2, html_or_msg, filename = fetch_and_convert_from_github(owner, repo, branch, selected, execute)
+    clicked = st.button("Convertir et afficher")
+    if clicked and not _discard_previous_execution():
+        st.warning("Une exécution est déjà en cours pour cette session ; attendez qu'elle se termine.")
+    elif clicked:
+        if execute and not progressive:
+            # Kernel-heavy: run in a worker process so the UI stays responsive
+            try:
+                html = _start_background_execution(used_source, owner, repo, branch, selected, blob_shas.get(selected))
+            except (RuntimeError, requests.RequestException) as e:
+                st.error(str(e))
+                return
+            if html is not None:
+                html = inject_custom_css(html, css_text) if apply_css else html
+                _show_html(html, Path(selected).stem + ".html", int(height))
+        elif used_source == "github":
+            with nullcontext() if progressive else st.spinner("Téléchargement et conversion…"):
+                ok2, html_or_msg, filename = fetch_and_convert_from_github(
+                    owner, repo, branch, selected, execute, blob_sha=blob_shas.get(selected), progressive=progressive
+                )
             if not ok2:
                 st.error(html_or_msg)
                 return
             html = inject_custom_css(html_or_msg, css_text) if apply_css else html_or_msg
-            out_name = Path(filename).stem + ".html"
+            _show_html(html, Path(filename).stem + ".html", int(height))
         else:
             notebooks_dir = app_root() / "notebooks"
             selected_path = notebooks_dir / selected
-            with st.spinner("Conversion en HTML…"):
-                base_html = convert_ipynb_to_html(selected_path, execute)
+            with nullcontext() if progressive else st.spinner("Conversion en HTML…"):
+                base_html = convert_ipynb_to_html(selected_path, execute, progressive=progressive)
                 html = inject_custom_css(base_html, css_text) if apply_css else base_html
-            out_name = selected_path.stem + ".html"
+            _show_html(html, selected_path.stem + ".html", int(height))
 
-        st.download_button("Télécharger HTML", data=html.encode("utf-8"), file_name=out_name, mime="text/html")
-        st.components.v1.html(html, height=int(height), scrolling=True)
+    job = st.session_state.get("exec_job")
+    if job is not None:
+        if not job["future"].done():
+            _wait_for_execution(job["future"])
+            return
+        st.session_state.pop("exec_job")
+        html = _finish_background_execution(job)
+        html = inject_custom_css(html, css_text) if apply_css else html
+        _show_html(html, job["out_name"], int(height))
 
 
-def convert_ipynb_to_html(nb_path: Path, execute: bool) -> str:
-    import nbformat
-    from nbconvert import HTMLExporter
+def _show_html(html: str, out_name: str, height: int) -> None:
+    st.download_button("Télécharger HTML", data=html.encode("utf-8"), file_name=out_name, mime="text/html")
+    st.components.v1.html(html, height=height, scrolling=True)
+
+
+@st.cache_resource(show_spinner=False)
+def _executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=2)
+
+
+def _discard_previous_execution() -> bool:
+    """Cancel this session's pending job; return False if it is already running.
+
+    A running worker cannot be stopped, so no second job is queued behind it.
+    """
+    job = st.session_state.get("exec_job")
+    if job is not None and not job["future"].cancel() and not job["future"].done():
+        return False
+    st.session_state.pop("exec_job", None)
+    return True
+
+
+def _start_background_execution(
+    used_source: str, owner: str, repo: str, branch: str, selected: str, blob_sha: Optional[str]
+) -> Optional[str]:
+    """Return cached HTML right away, or submit execution to the worker pool.
+
+    A submitted job is remembered in ``st.session_state["exec_job"]`` and
+    picked up by later reruns once its future has completed.
+    """
+    if used_source == "github":
+        if blob_sha:
+            cached = _get_cached_html(blob_sha, True)
+            if cached is not None:
+                return cached
+        nb_bytes = _download_notebook(owner, repo, branch, selected)
+        cwd = "."
+    else:
+        nb_path = app_root() / "notebooks" / selected
+        nb_bytes = nb_path.read_bytes()
+        cwd = str(nb_path.parent)
+    sha = _content_key(nb_bytes, blob_sha)
+    cached = _get_cached_html(sha, True)
+    if cached is not None:
+        return cached
+    st.session_state["exec_job"] = {
+        "future": _executor().submit(execute_notebook, nb_bytes, cwd),
+        "nb_bytes": nb_bytes,
+        "cwd": cwd,
+        "sha": sha,
+        "out_name": Path(selected).stem + ".html",
+    }
+    return None
+
+
+@st.fragment(run_every=2)
+def _wait_for_execution(future: Future) -> None:
+    # Polls without rerunning the whole app; a full rerun picks up the result
+    if future.done():
+        st.rerun()
+    st.info("Exécution du notebook en cours dans un processus séparé…")
+
+
+def _finish_background_execution(job: Dict[str, Any]) -> str:
+    try:
+        executed_bytes = job["future"].result()
+    except Exception as e:  # noqa: BLE001
+        # Fallback: render without executing if the kernel failed
+        st.warning(f"Exécution impossible ({e}); rendu sans exécution.")
+        return _convert_impl(job["nb_bytes"], False, job["cwd"], job["sha"])
+    node = _read_notebook(executed_bytes)
+    _shrink_outputs(node)
+    html = _export_notebook_html(node)
+    _set_cached_html(job["sha"], True, html)
+    return html
+
+
+def _list_local(root: Path) -> List[str]:
+    """List notebooks under ``root`` as relative paths, never descending into checkpoints."""
+    out: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != ".ipynb_checkpoints"]
+        out.extend(os.path.relpath(os.path.join(dirpath, fn), root) for fn in filenames if fn.endswith(".ipynb"))
+    out.sort(key=str.lower)
+    return out
+
+
+def convert_ipynb_to_html(nb_path: Path, execute: bool, progressive: bool = False) -> str:
+    nb_bytes = nb_path.read_bytes()
+    sha = hashlib.sha256(nb_bytes).hexdigest()
+    if execute and progressive:
+        return _convert_with_progress(nb_bytes, str(nb_path.parent), sha)
+    return _convert_impl(nb_bytes, execute, str(nb_path.parent), sha)
+
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def _convert_impl(nb_bytes: bytes, execute: bool, cwd: str, sha: str) -> str:
+    """Convert raw notebook bytes to HTML; cached on the content, not the path.
+
+    ``sha`` identifies the content in the on-disk tier, which outlives the
+    process (GitHub blob SHA, or SHA-256 of the bytes for local files).
+    """
     from nbconvert.preprocessors import ExecutePreprocessor
 
-    node = nbformat.read(str(nb_path), as_version=4)
+    cached = _get_cached_html(sha, execute)
+    if cached is not None:
+        return cached
+
+    node = _read_notebook(nb_bytes)
+    executed = True
     if execute:
         try:
-            kernel_name = (
-                getattr(getattr(node, "metadata", {}), "get", lambda *_: None)("kernelspec", {}) or {}
-            ).get("name") or "python3"
-            ep = ExecutePreprocessor(timeout=300, kernel_name=kernel_name)
-            ep.preprocess(node, {"metadata": {"path": str(nb_path.parent)}})
+            ep = ExecutePreprocessor(timeout=300, kernel_name=_kernel_name(node))
+            ep.preprocess(node, {"metadata": {"path": cwd}})
         except Exception:
             # Fallback: render without executing if kernel is unavailable
-            pass
-    return _export_notebook_html(node)
+            executed = False
+    _shrink_outputs(node)
+    html = _export_notebook_html(node)
+    if executed:
+        _set_cached_html(sha, execute, html)
+    return html
 
 
-def list_ipynb_from_github(owner: str, repo: str, branch: str, directory: str) -> Tuple[bool, List[str]]:
-    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{directory}?ref={branch}"
-    resp = requests.get(url, headers=_github_headers(), timeout=20)
-    if resp.status_code != 200:
-        return False, f"GitHub API error {resp.status_code}: {resp.text[:200]}"
-    items = resp.json()
-    files = [item["path"] for item in items if item.get("type") == "file" and item.get("name", "").endswith(".ipynb")]
-    # Also include subdirectories' notebooks (one level deep)
-    dirs = [item["path"] for item in items if item.get("type") == "dir"]
-    for d in dirs:
-        sub_url = f"https://api.github.com/repos/{owner}/{repo}/contents/{d}?ref={branch}"
-        sub_resp = requests.get(sub_url, headers=_github_headers(), timeout=20)
-        if sub_resp.status_code == 200:
-            sub_items = sub_resp.json()
-            files.extend([it["path"] for it in sub_items if it.get("type") == "file" and it.get("name", "").endswith(".ipynb")])
-    files.sort(key=lambda s: s.lower())
-    return True, files
+def _convert_with_progress(nb_bytes: bytes, cwd: str, sha: str) -> str:
+    """Execute and convert a notebook, echoing each cell in a status panel as soon as it has run.
+
+    Not cached with st.cache_data since it writes to the page; the disk tier still applies.
+    """
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    cached = _get_cached_html(sha, True)
+    if cached is not None:
+        return cached
+
+    node = _read_notebook(nb_bytes)
+    total = len(node.cells)
+    executed = True
+    with st.status("Exécution du notebook…", expanded=True) as status:
+        ep = ExecutePreprocessor(timeout=300, kernel_name=_kernel_name(node))
+        run_cell = ep.preprocess_cell
 
+        def preprocess_cell(cell, resources, index):
+            status.update(label=f"Exécution de la cellule {index + 1}/{total}…")
+            cell, resources = run_cell(cell, resources, index)
+            _echo_cell(cell)
+            return cell, resources
 
-def fetch_and_convert_from_github(owner: str, repo: str, branch: str, path: str, execute: bool) -> Tuple[bool, str, str]:
+        ep.preprocess_cell = preprocess_cell
+        try:
+            ep.preprocess(node, {"metadata": {"path": cwd}})
+        except Exception as e:  # noqa: BLE001
+            executed = False
+            status.update(label=f"Exécution interrompue: {e}", state="error", expanded=False)
+        else:
+            status.update(label="Exécution terminée", state="complete", expanded=False)
+    _shrink_outputs(node)
+    html = _export_notebook_html(node)
+    if executed:
+        _set_cached_html(sha, True, html)
+    return html
+
+
+def _echo_cell(cell) -> None:
+    """Write a quick native preview of one executed cell into the current container."""
+    source = cell.get("source", "")
+    if cell.get("cell_type") == "markdown":
+        st.markdown(source)
+        return
+    if cell.get("cell_type") != "code":
+        return
+    st.code(source, language="python")
+    for output in cell.get("outputs", []):
+        data = output.get("data", {})
+        if output.get("output_type") == "stream":
+            st.text(output.get("text", ""))
+        elif output.get("output_type") == "error":
+            st.error(f"{output.get('ename')}: {output.get('evalue')}")
+        elif "image/png" in data:
+            st.image(base64.b64decode(data["image/png"]))
+        elif "text/plain" in data:
+            st.text(data["text/plain"])
+
+
+def _kernel_name(node) -> str:
+    return (
+        getattr(getattr(node, "metadata", {}), "get", lambda *_: None)("kernelspec", {}) or {}
+    ).get("name") or "python3"
+
+
+def _get_cached_html(sha: str, execute: bool) -> Optional[str]:
+    """Return rendered HTML from the disk tier, or None on a miss."""
+    import zstandard
+
+    blob = _cache.get(("html-zst", sha, execute))
+    if blob is None:
+        return None
+    return zstandard.ZstdDecompressor().decompress(blob).decode("utf-8")
+
+
+def _set_cached_html(sha: str, execute: bool, html: str) -> None:
+    # zstd shrinks notebook HTML several-fold and decompresses faster than the disk reads it
+    import zstandard
+
+    blob = zstandard.ZstdCompressor(level=3).compress(html.encode("utf-8"))
+    _cache.set(("html-zst", sha, execute), blob, tag="html")
+
+
+def _read_notebook(nb_bytes: bytes):
+    """Parse notebook bytes with orjson instead of nbformat's stdlib json pass.
+
+    Schema validation is skipped on purpose: the exporter validates once anyway.
+    """
     import nbformat
-    from nbconvert import HTMLExporter
-    from nbconvert.preprocessors import ExecutePreprocessor
+    import orjson
 
-    raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
-    r = requests.get(raw_url, headers=_github_headers(raw=True), timeout=30)
-    if r.status_code != 200:
-        return False, f"Téléchargement échoué ({r.status_code}).", path
     try:
-        node = nbformat.reads(r.text, as_version=4)
-        if execute:
-            try:
-                kernel_name = (
-                    getattr(getattr(node, "metadata", {}), "get", lambda *_: None)("kernelspec", {}) or {}
-                ).get("name") or "python3"
-                ep = ExecutePreprocessor(timeout=300, kernel_name=kernel_name)
-                ep.preprocess(node, {"metadata": {"path": "."}})
-            except Exception:
-                pass
-        body = _export_notebook_html(node)
+        nb_dict = orjson.loads(nb_bytes)
+        major, minor = nbformat.reader.get_version(nb_dict)
+        node = nbformat.versions[major].to_notebook_json(nb_dict, minor=minor)
+        return nbformat.convert(node, 4)
+    except Exception:
+        # Unusual or malformed files: let nbformat's own reader handle them
+        return nbformat.convert(nbformat.reader.reads(nb_bytes.decode("utf-8")), 4)
+
+
+def _shrink_outputs(node, max_kb: int = 256) -> None:
+    """Downsample oversize PNG outputs in place once the notebook exceeds its image budget.
+
+    Each embedded image is re-inlined as base64 by nbconvert, so a few large
+    plots are enough to push the HTML into megabytes.
+    """
+    images = [
+        output["data"]
+        for cell in node.get("cells", [])
+        if cell.get("cell_type") == "code"
+        for output in cell.get("outputs", [])
+        if isinstance(output.get("data", {}).get("image/png"), str)
+    ]
+    if sum(len(data["image/png"]) for data in images) <= _IMAGE_BUDGET_BYTES:
+        return
+
+    from PIL import Image
+
+    for data in images:
+        if len(data["image/png"]) <= max_kb * 1024:
+            continue
+        try:
+            img = Image.open(BytesIO(base64.b64decode(data["image/png"])))
+            img.thumbnail((800, 800))
+            buf = BytesIO()
+            img.save(buf, format="PNG", optimize=True)
+        except Exception:
+            # Keep the original image if it cannot be decoded
+            continue
+        data["image/png"] = base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def list_ipynb_from_github(owner: str, repo: str, branch: str, directory: str) -> Tuple[bool, Dict[str, str]]:
+    """List notebooks under ``directory`` as an ordered mapping of path to blob SHA."""
+    try:
+        return True, _cached_list(owner, repo, branch, directory)
+    except (RuntimeError, requests.RequestException) as e:
+        return False, str(e)
+
+
+@st.cache_data(ttl=300, show_spinner="Chargement de la liste des notebooks…")
+def _cached_list(owner: str, repo: str, branch: str, directory: str) -> Dict[str, str]:
+    # In-memory tier in front of the disk memo: reruns that only change the
+    # filter or the selection never touch diskcache or the network
+    return _list_ipynb_entries(owner, repo, branch, directory)
+
+
+@_cache.memoize(expire=600, tag="gh-list")
+def _list_ipynb_entries(owner: str, repo: str, branch: str, directory: str) -> Dict[str, str]:
+    # Raises on failure so that errors are never memoized
+    tree = _recursive_tree(owner, repo, branch)
+    if tree is None:
+        return _list_ipynb_entries_via_contents(owner, repo, branch, directory)
+    prefix = directory.strip("/") + "/" if directory.strip("/") else ""
+    files = [
+        (item["path"], item["sha"])
+        for item in tree
+        if item.get("type") == "blob" and item["path"].startswith(prefix) and item["path"].endswith(".ipynb")
+    ]
+    files.sort(key=lambda f: f[0].lower())
+    return dict(files)
+
+
+def _recursive_tree(owner: str, repo: str, branch: str) -> Optional[List[Dict[str, Any]]]:
+    """Return the flat recursive Git tree of ``branch``, or None if GitHub truncated it."""
+    sha = branch
+    if not _SHA_RE.fullmatch(branch):
+        ref = _github_get_json(f"https://api.github.com/repos/{owner}/{repo}/git/ref/heads/{branch}")
+        sha = ref["object"]["sha"]
+    data = _github_get_json(f"https://api.github.com/repos/{owner}/{repo}/git/trees/{sha}?recursive=1")
+    if data.get("truncated"):
+        return None
+    return data.get("tree", [])
+
+
+def _list_ipynb_entries_via_contents(owner: str, repo: str, branch: str, directory: str) -> Dict[str, str]:
+    # Fallback for trees too large for a single recursive listing
+    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{directory}?ref={branch}"
+    items = _github_get_json(url)
+    files = [
+        (item["path"], item["sha"])
+        for item in items
+        if item.get("type") == "file" and item.get("name", "").endswith(".ipynb")
+    ]
+    # Also include subdirectories' notebooks (one level deep)
+    dirs = [item["path"] for item in items if item.get("type") == "dir"]
+    sub_urls = [f"https://api.github.com/repos/{owner}/{repo}/contents/{d}?ref={branch}" for d in dirs]
+
+    def fetch_listing(sub_url: str) -> List[Dict[str, Any]]:
+        try:
+            return _github_get_json(sub_url)
+        except RuntimeError:
+            return []
+
+    # I/O-bound: overlap the per-directory requests instead of paying one RTT each
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        for sub_items in ex.map(fetch_listing, sub_urls):
+            files.extend([
+                (it["path"], it["sha"])
+                for it in sub_items
+                if it.get("type") == "file" and it.get("name", "").endswith(".ipynb")
+            ])
+    files.sort(key=lambda f: f[0].lower())
+    return dict(files)
+
+
+def _github_get_json(url: str):
+    status, body = _conditional_get(url, _github_headers(), timeout=20)
+    if status != 200:
+        raise RuntimeError(f"GitHub API error {status}: {body[:200].decode('utf-8', 'replace')}")
+    return json.loads(body)
+
+
+def _conditional_get(url: str, headers: Mapping[str, str], timeout: int) -> Tuple[int, bytes]:
+    """GET ``url``, revalidating the last successful response with its ETag.
+
+    A 304 answer reuses the stored body, does not count against GitHub's rate
+    limit, and extends the stored entry's lifetime. Returns ``(status, body)``.
+    """
+    cached = _cache.get(("etag", url))
+    if cached is not None:
+        headers = {**headers, "If-None-Match": cached[0]}
+    resp = _http_session().get(url, headers=headers, timeout=timeout)
+    if resp.status_code == 304 and cached is not None:
+        _cache.touch(("etag", url), expire=_ETAG_TTL)
+        return 200, cached[1]
+    etag = resp.headers.get("ETag")
+    if resp.status_code == 200 and etag:
+        _cache.set(("etag", url), (etag, resp.content), expire=_ETAG_TTL, tag="etag")
+    return resp.status_code, resp.content
+
+
+def fetch_and_convert_from_github(
+    owner: str,
+    repo: str,
+    branch: str,
+    path: str,
+    execute: bool,
+    blob_sha: Optional[str] = None,
+    progressive: bool = False,
+) -> Tuple[bool, str, str]:
+    # With the blob SHA from the listing, a disk hit skips the download entirely
+    if blob_sha:
+        cached = _get_cached_html(blob_sha, execute)
+        if cached is not None:
+            return True, cached, path
+    try:
+        nb_bytes = _download_notebook(owner, repo, branch, path)
+    except (RuntimeError, requests.RequestException) as e:
+        return False, str(e), path
+    try:
+        sha = _content_key(nb_bytes, blob_sha)
+        if execute and progressive:
+            body = _convert_with_progress(nb_bytes, ".", sha)
+        else:
+            body = _convert_impl(nb_bytes, execute, ".", sha)
         return True, body, path
     except Exception as e:  # noqa: BLE001
         return False, f"Erreur conversion: {e}", path
 
 
-def _github_headers(raw: bool = False) -> Dict[str, str]:
+def _content_key(nb_bytes: bytes, blob_sha: Optional[str]) -> str:
+    """Key rendered HTML on the listing's blob SHA only if the bytes really are that blob.
+
+    Raw downloads can lag the tree listing after a push; stale bytes must not
+    be stored under the new SHA.
+    """
+    if blob_sha and hashlib.sha1(b"blob %d\0" % len(nb_bytes) + nb_bytes).hexdigest() == blob_sha:
+        return blob_sha
+    return hashlib.sha256(nb_bytes).hexdigest()
+
+
+def _prefetch_notebooks(owner: str, repo: str, branch: str, paths: List[str]) -> int:
+    """Download notebooks concurrently over one HTTP/2 connection into the ETag store.
+
+    Later conversions then only revalidate (304) instead of downloading.
+    Notebooks already stored are skipped. Returns the number newly stored.
+    """
+    import asyncio
+    import httpx
+
+    urls = [f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{p}" for p in paths]
+    urls = [u for u in urls if ("etag", u) not in _cache]
+
+    async def fetch_all():
+        slots = asyncio.Semaphore(16)
+        async with httpx.AsyncClient(http2=True, headers=_github_headers(raw=True), timeout=30) as client:
+
+            async def fetch(url: str):
+                async with slots:
+                    try:
+                        return url, await client.get(url)
+                    except httpx.HTTPError:
+                        return url, None
+
+            return await asyncio.gather(*(fetch(u) for u in urls))
+
+    stored = 0
+    for url, resp in asyncio.run(fetch_all()):
+        if resp is None or resp.status_code != 200 or not resp.headers.get("ETag"):
+            continue
+        _cache.set(("etag", url), (resp.headers["ETag"], resp.content), expire=_ETAG_TTL, tag="etag")
+        stored += 1
+    return stored
+
+
+def _download_notebook(owner: str, repo: str, branch: str, path: str) -> bytes:
+    # Not memoized: the ETag store already turns repeat downloads into 304s,
+    # and a longer-lived tier would hide new content pushed to the branch
+    raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
+    status, body = _conditional_get(raw_url, _github_headers(raw=True), timeout=30)
+    if status != 200:
+        raise RuntimeError(f"Téléchargement échoué ({status}).")
+    return body
+
+
+@functools.lru_cache(maxsize=2)
+def _github_headers(raw: bool = False) -> Mapping[str, str]:
     """Return headers for GitHub requests, using token from Streamlit secrets if available.
 
+    Memoized so that loops over many requests read the secrets once; the
+    result is read-only since it is shared between callers.
+
     Set a token in Streamlit Cloud under Secrets as:
       GITHUB_TOKEN = "ghp_xxx"  (fine-grained read-only is recommended)
     """
@@ -172,7 +651,35 @@ def _github_headers(raw: bool = False) -> Dict[str, str]:
     if not raw:
         headers["Accept"] = "application/vnd.github+json"
         headers["X-GitHub-Api-Version"] = "2022-11-28"
-    return headers
+    return MappingProxyType(headers)
+
+
+_FALLBACK_HEADER = (
+    "<!doctype html><meta charset='utf-8'><style>body{font-family:system-ui;max-width:960px;margin:2rem auto;padding:0 1rem;line-height:1.6}.code-cell pre{background:#111;color:#eee;padding:0.75rem;border-radius:6px;overflow:auto}</style>"
+)
+# Opening and closing markup per cell type for the minimal renderer
+_FALLBACK_CELL_MARKUP = {
+    "markdown": ('<div class="md-cell"><pre>', "</pre></div>"),
+    "code": ('<div class="code-cell"><pre><code>', "</code></pre></div>"),
+}
+_FALLBACK_RAW_MARKUP = ('<div class="raw-cell"><pre>', "</pre></div>")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_exporter(template: str = "classic"):
+    """Build an HTMLExporter once per process; template discovery and Jinja setup are slow.
+
+    Exports register per-notebook filters on the shared Jinja environment, so
+    the exporter comes with a lock that sessions (threads) must hold around it.
+    """
+    from nbconvert import HTMLExporter
+
+    exp = HTMLExporter(template_name=template)
+    exp.exclude_output_prompt = True
+    exp.exclude_input_prompt = True
+    # Validate once after all preprocessors instead of after each of them
+    exp.optimistic_validation = True
+    return exp, threading.Lock()
 
 
 def _export_notebook_html(node) -> str:
@@ -182,52 +689,36 @@ def _export_notebook_html(node) -> str:
     """
     # Try 'classic'
     try:
-        exp = HTMLExporter(template_name="classic")
-        exp.exclude_output_prompt = True
-        exp.exclude_input_prompt = True
-        body, _ = exp.from_notebook_node(node)
+        exporter, lock = _get_exporter("classic")
+        with lock:
+            body, _ = exporter.from_notebook_node(node)
         return body
     except Exception:
         pass
 
     # Try 'basic'
     try:
-        exp = HTMLExporter(template_name="basic")
-        exp.exclude_output_prompt = True
-        exp.exclude_input_prompt = True
-        body, _ = exp.from_notebook_node(node)
+        exporter, lock = _get_exporter("basic")
+        with lock:
+            body, _ = exporter.from_notebook_node(node)
         return body
     except Exception:
         pass
 
     # Minimal fallback
     try:
-        cells_html = []
+        buf = StringIO()
+        buf.write(_FALLBACK_HEADER)
         for cell in node.get("cells", []):
-            ctype = cell.get("cell_type")
-            src = "".join(cell.get("source", []))
-            if ctype == "markdown":
-                cells_html.append(f"<div class=\"md-cell\"><pre>{_html_escape(src)}</pre></div>")
-            elif ctype == "code":
-                cells_html.append(f"<div class=\"code-cell\"><pre><code>{_html_escape(src)}</code></pre></div>")
-            else:
-                cells_html.append(f"<div class=\"raw-cell\"><pre>{_html_escape(src)}</pre></div>")
-        return (
-            "<!doctype html><meta charset='utf-8'><style>body{font-family:system-ui;max-width:960px;margin:2rem auto;padding:0 1rem;line-height:1.6}.code-cell pre{background:#111;color:#eee;padding:0.75rem;border-radius:6px;overflow:auto}</style>"
-            + "".join(cells_html)
-        )
+            opening, closing = _FALLBACK_CELL_MARKUP.get(cell.get("cell_type"), _FALLBACK_RAW_MARKUP)
+            buf.write(opening)
+            buf.write(escape("".join(cell.get("source", [])), quote=False))
+            buf.write(closing)
+        return buf.getvalue()
     except Exception:
         return "<p>Impossible de convertir le notebook en HTML.</p>"
 
 
-def _html_escape(text: str) -> str:
-    return (
-        text.replace("&", "&amp;")
-        .replace("<", "&lt;")
-        .replace(">", "&gt;")
-    )
-
-
 def inject_custom_css(html: str, css: str) -> str:
     """Insert a <style> tag with provided CSS into HTML string.
 
@@ -236,19 +727,14 @@ def inject_custom_css(html: str, css: str) -> str:
     if not css.strip():
         return html
     style_tag = f"<style>\n{css}\n</style>"
-    lower = html.lower()
-    head_idx = lower.find("<head>")
-    if head_idx != -1:
-        insert_at = head_idx + len("<head>")
-        return html[:insert_at] + style_tag + html[insert_at:]
+    head = _HEAD_TAG_RE.search(html)
+    if head:
+        return html[:head.end()] + style_tag + html[head.end():]
     # If there is a <html> but no head, create one after <html>
-    html_idx = lower.find("<html")
-    if html_idx != -1:
-        # Find end of <html ...>
-        end_tag = lower.find(">", html_idx)
-        if end_tag != -1:
-            insert_at = end_tag + 1
-            return html[:insert_at] + "<head>" + style_tag + "</head>" + html[insert_at:]
+    html_tag = _HTML_TAG_RE.search(html)
+    if html_tag:
+        insert_at = html_tag.end()
+        return html[:insert_at] + "<head>" + style_tag + "</head>" + html[insert_at:]
     # Fallback: prepend
     return style_tag + html
 
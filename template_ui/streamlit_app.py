@@ -3,23 +3,34 @@ from __future__ import annotations
 import json
 from datetime import date
 import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict
 
 import streamlit as st
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateError
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib parser
+    orjson = None
 
 
 def get_templates_directory() -> Path:
     return Path(__file__).parent / "templates"
 
 
-def list_available_templates(templates_dir: Path) -> list[str]:
-    return sorted([template_path.name for template_path in templates_dir.glob("*.j2")])
+@st.cache_data(show_spinner=False, ttl=60)
+def list_available_templates(templates_dir_str: str) -> list[str]:
+    return sorted(template_path.name for template_path in Path(templates_dir_str).glob("*.j2"))
 
 
-def get_default_context_for_template(template_name: str) -> Dict[str, Any]:
-    today_string = str(date.today())
+def get_default_context_for_template(template_name: str, today_string: str | None = None) -> Dict[str, Any]:
+    if today_string is None:
+        today_string = str(date.today())
 
     defaults: Dict[str, Dict[str, Any]] = {
         "simple_report.html.j2": {
@@ -109,6 +120,22 @@ def get_default_context_for_template(template_name: str) -> Dict[str, Any]:
     return defaults.get(template_name, {"title": "Document", "date": today_string})
 
 
+@st.cache_data(show_spinner=False)
+def _default_context_json(template_name: str, today_string: str) -> str:
+    # Keyed on the day so the dated defaults roll over at midnight
+    default_context = get_default_context_for_template(template_name, today_string)
+    if orjson is not None:
+        return orjson.dumps(default_context, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(default_context, ensure_ascii=False, indent=2)
+
+
+def _parse_context_json(text: str) -> Any:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either
+    if orjson is not None:
+        return orjson.loads(text.encode("utf-8"))
+    return json.loads(text)
+
+
 def detect_output_extension(template_name: str) -> str:
     if template_name.endswith(".html.j2"):
         return "html"
@@ -117,23 +144,65 @@ def detect_output_extension(template_name: str) -> str:
     return "txt"
 
 
-def render_template_to_string(template_name: str, context: Dict[str, Any]) -> str:
-    templates_dir = get_templates_directory()
-    env = Environment(loader=FileSystemLoader(str(templates_dir)), autoescape=False)
-    template = env.get_template(template_name)
-    return template.render(**context)
+_OUTPUT_MIME_TYPES = {"html": "text/html", "md": "text/markdown"}
 
 
-def save_output(content: str, template_name: str) -> Path:
+def _output_meta(template_name: str) -> tuple[str, str, str]:
+    """Return (base name, extension, MIME type) of the file a template produces."""
     output_extension = detect_output_extension(template_name)
-    base_name = Path(template_name).stem
-    # Remove double extension patterns like .html.j2 -> .html
-    base_name = base_name.replace(".html", "").replace(".md", "")
+    # Drop the inner extension of names like report.html.j2
+    base_name = Path(template_name).stem.removesuffix(f".{output_extension}")
+    return base_name, output_extension, _OUTPUT_MIME_TYPES.get(output_extension, "text/plain")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_jinja_env() -> Environment:
+    # Shared across reruns so Jinja's template cache keeps compiled templates;
+    # templates ship with the app, hence no mtime checks on every lookup.
+    # The bytecode cache also survives process restarts; without a directory,
+    # Jinja uses a private per-user folder and checks its owner and mode.
+    return Environment(
+        loader=FileSystemLoader(str(get_templates_directory())),
+        autoescape=False,
+        auto_reload=False,
+        cache_size=400,
+        bytecode_cache=FileSystemBytecodeCache(pattern="%s.cache"),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_templates() -> None:
+    # Compile every shipped template once per process so no click pays for it;
+    # a broken template is left to surface its error when it is rendered.
+    env = _get_jinja_env()
+    for template_name in list_available_templates(str(get_templates_directory())):
+        try:
+            env.get_template(template_name)
+        except TemplateError:
+            pass
+
+
+def render_template_to_string(template_name: str, context: Dict[str, Any]) -> str:
+    return _get_jinja_env().get_template(template_name).render(**context)
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _render_cached(template_name: str, context_key: str) -> str:
+    # context_key is the canonical JSON of the context, so equal inputs hit the cache
+    return render_template_to_string(template_name, json.loads(context_key))
+
+
+def save_output(content_bytes: bytes, template_name: str) -> Path:
+    base_name, output_extension, _ = _output_meta(template_name)
 
     output_dir = Path(__file__).parent / "output"
-    output_dir.mkdir(parents=True, exist_ok=True)
     output_path = output_dir / f"{base_name}_output.{output_extension}"
-    output_path.write_text(content, encoding="utf-8")
+    try:
+        output_path.write_bytes(content_bytes)
+    except FileNotFoundError:
+        # Create the folder only when it is missing rather than on every save
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output_path.write_bytes(content_bytes)
     return output_path
 
 
@@ -147,7 +216,7 @@ def _ui_templates_tab() -> None:
         st.markdown("- ZIP: à venir — packer plusieurs rendus")
 
     templates_dir = get_templates_directory()
-    available_templates = list_available_templates(templates_dir)
+    available_templates = list_available_templates(str(templates_dir))
 
     if not available_templates:
         st.error(
@@ -157,8 +226,7 @@ def _ui_templates_tab() -> None:
 
     selected_template = st.selectbox("Template", available_templates, index=0)
 
-    default_context = get_default_context_for_template(selected_template)
-    context_json_default = json.dumps(default_context, ensure_ascii=False, indent=2)
+    context_json_default = _default_context_json(selected_template, str(date.today()))
 
     st.subheader("Variables du template (JSON)")
     context_json_input = st.text_area(
@@ -168,45 +236,59 @@ def _ui_templates_tab() -> None:
     )
 
     generate_clicked = st.button("Générer le document")
+    # Identifies the inputs of the last generation, to re-show it on later reruns
+    fingerprint = (selected_template, hash(context_json_input))
 
     if generate_clicked:
         try:
-            context = json.loads(context_json_input)
+            context = _parse_context_json(context_json_input)
         except json.JSONDecodeError as error:
             st.error(f"JSON invalide: {error}")
             return
 
         try:
-            rendered = render_template_to_string(selected_template, context)
+            context_key = json.dumps(context, sort_keys=True, ensure_ascii=False)
+            rendered = _render_cached(selected_template, context_key)
         except Exception as error:  # noqa: BLE001 - surface error to UI
             st.error(f"Erreur lors du rendu du template: {error}")
             return
 
-        output_path = save_output(rendered, selected_template)
-
-        st.success(f"Document généré: {output_path}")
-
-        output_extension = detect_output_extension(selected_template)
-        if output_extension == "html":
-            st.subheader("Aperçu HTML")
-            st.components.v1.html(rendered, height=800, scrolling=True)
-        elif output_extension == "md":
-            st.subheader("Aperçu Markdown")
-            st.markdown(rendered)
-        else:
-            st.subheader("Aperçu (texte)")
-            st.code(rendered)
-
-        st.download_button(
-            label="Télécharger",
-            data=rendered.encode("utf-8"),
-            file_name=output_path.name,
-            mime=(
-                "text/html"
-                if output_extension == "html"
-                else "text/markdown" if output_extension == "md" else "text/plain"
-            ),
-        )
+        # Encode once; the same bytes are written to disk and offered for download
+        rendered_bytes = rendered.encode("utf-8")
+        output_path = save_output(rendered_bytes, selected_template)
+        st.session_state["last_render"] = {
+            "fp": fingerprint,
+            "text": rendered,
+            "bytes": rendered_bytes,
+            "path": str(output_path),
+        }
+    else:
+        last_render = st.session_state.get("last_render")
+        if not last_render or last_render["fp"] != fingerprint:
+            return
+        rendered = last_render["text"]
+        rendered_bytes = last_render["bytes"]
+        output_path = Path(last_render["path"])
+
+    st.success(f"Document généré: {output_path}")
+
+    _, output_extension, output_mime = _output_meta(selected_template)
+    if output_extension == "html":
+        st.subheader("Aperçu HTML")
+        st.components.v1.html(rendered, height=800, scrolling=True)
+    elif output_extension == "md":
+        st.subheader("Aperçu Markdown")
+        st.markdown(rendered)
+    else:
+        st.subheader("Aperçu (texte)")
+        st.code(rendered)
+
+    st.download_button(
+        label="Télécharger",
+        data=rendered_bytes,
+        file_name=output_path.name,
+        mime=output_mime,
+    )
 
 
 def _get_default_notebooks_directory() -> Path:
@@ -219,11 +301,40 @@ def _get_default_notebooks_directory() -> Path:
     return repo_root / "PythonDataScienceHandbook" / "notebooks"
 
 
-def _list_notebooks(notebooks_dir: Path) -> list[Path]:
-    return sorted(
-        [p for p in notebooks_dir.rglob("*.ipynb") if ".ipynb_checkpoints" not in str(p)],
-        key=lambda p: str(p).lower(),
-    )
+def _walk_notebooks(top: str) -> list[str]:
+    found: list[str] = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = [d for d in dirnames if d != ".ipynb_checkpoints"]
+        found.extend(os.path.join(dirpath, fn) for fn in filenames if fn.endswith(".ipynb"))
+    return found
+
+
+@st.cache_data(show_spinner=False, ttl=60)
+def _list_notebooks_cached(notebooks_dir_str: str, mtime_ns: int) -> list[str]:
+    # mtime_ns only invalidates on top-level changes; the ttl catches nested ones
+    found: list[str] = []
+    subdirs: list[str] = []
+    with os.scandir(notebooks_dir_str) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != ".ipynb_checkpoints":
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(".ipynb"):
+                found.append(entry.path)
+    # I/O-bound: walk the top-level folders concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for sub_found in executor.map(_walk_notebooks, subdirs):
+            found.extend(sub_found)
+    # POSIX separators keep labels and ordering identical across platforms;
+    # sort keys are computed once per entry and the result is cached anyway
+    found = [Path(os.path.relpath(path, notebooks_dir_str)).as_posix() for path in found]
+    found.sort(key=str.lower)
+    return found
+
+
+def _list_notebooks(notebooks_dir: Path) -> list[str]:
+    """Return notebook paths relative to notebooks_dir."""
+    return _list_notebooks_cached(str(notebooks_dir), notebooks_dir.stat().st_mtime_ns)
 
 
 def _compute_notebook_cache_key(notebook_path: Path, execute: bool) -> str:
@@ -232,32 +343,161 @@ def _compute_notebook_cache_key(notebook_path: Path, execute: bool) -> str:
         raw_key = f"{notebook_path}:{stat_info.st_mtime_ns}:{stat_info.st_size}:{execute}"
     except FileNotFoundError:
         raw_key = f"{notebook_path}:missing:{execute}"
-    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(raw_key.encode("utf-8"), digest_size=16).hexdigest()
 
 
-def _convert_notebook_to_html(notebook_path: Path, execute: bool) -> str:
-    import nbformat  # lazy import
+@st.cache_resource(show_spinner=False)
+def _get_html_exporter():
+    # One exporter per process: template discovery and its Jinja setup are slow.
+    # Streamlit sessions run in separate threads, hence the lock around exports.
     from nbconvert import HTMLExporter
-    from nbconvert.preprocessors import ExecutePreprocessor
-
-    notebook_node = nbformat.read(str(notebook_path), as_version=4)
-
-    if execute:
-        ep = ExecutePreprocessor(timeout=300, kernel_name="python3")
-        ep.preprocess(notebook_node, {"metadata": {"path": str(notebook_path.parent)}})
 
     exporter = HTMLExporter()
     exporter.exclude_input = False
     exporter.exclude_output_prompt = True
     exporter.exclude_input_prompt = True
-    body, _ = exporter.from_notebook_node(notebook_node)
+    # Validate once after all preprocessors instead of after each of them
+    exporter.optimistic_validation = True
+    return exporter, threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _running_kernels() -> list:
+    # (kernel manager, lock) pairs still in service
+    return []
+
+
+@st.cache_resource(show_spinner=False)
+def _get_kernel(cwd: str):
+    # One long-lived kernel per notebook folder, so executions skip kernel startup.
+    # Before each run its namespace and cwd are reset (see _reset_kernel_state).
+    from jupyter_client.manager import KernelManager
+
+    km = KernelManager(kernel_name="python3")
+    km.start_kernel(cwd=cwd)
+    kernel = (km, threading.Lock())
+    _running_kernels().append(kernel)
+    return kernel
+
+
+def _reset_kernel_state(km, cwd: str) -> None:
+    # Clears user variables and returns to the notebook folder. Imported modules
+    # and library-level state (matplotlib settings, sys.path edits...) do survive
+    # between runs; a cell error or timeout restarts the kernel afresh.
+    kc = km.blocking_client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=60)
+        code = f"%reset -f\n__import__('os').chdir({cwd!r})"
+        kc.execute_interactive(code, store_history=False, timeout=60)
+    finally:
+        kc.stop_channels()
+
+
+def _shutdown_kernels() -> None:
+    # Forget the kernels first so new runs start fresh ones, then wait for each
+    # kernel's current run to finish before stopping it
+    _get_kernel.clear()
+    kernels = _running_kernels()
+    while kernels:
+        km, kernel_lock = kernels.pop()
+        with kernel_lock:
+            try:
+                km.shutdown_kernel(now=True)
+            except Exception:  # noqa: BLE001 - kernel may already be gone
+                pass
+
+
+def _execute_notebook(notebook_node, cwd: str) -> None:
+    # Only executing renders need nbclient and jupyter_client
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    while True:
+        kernel = _get_kernel(cwd)
+        km, kernel_lock = kernel
+        with kernel_lock:
+            if kernel not in _running_kernels():
+                # Shut down while this run waited for the lock; get a new one
+                continue
+            if not km.is_alive():
+                km.restart_kernel(now=True)
+            ep = ExecutePreprocessor(timeout=300, kernel_name="python3")
+            try:
+                _reset_kernel_state(km, cwd)
+                ep.preprocess(notebook_node, {"metadata": {"path": cwd}}, km=km)
+            except Exception:
+                # A failed or timed-out run may leave the kernel busy or dirty
+                km.restart_kernel(now=True)
+                raise
+            finally:
+                # The kernel is kept alive, only the per-run client is closed
+                if ep.kc is not None:
+                    ep.kc.stop_channels()
+            return
+
+
+def _convert_notebook_to_html(notebook_path: Path, execute: bool) -> str:
+    import nbformat  # lazy import
+
+    raw = notebook_path.read_bytes()
+    notebook_node = nbformat.reads(raw.decode("utf-8"), as_version=4)
+
+    if execute:
+        _execute_notebook(notebook_node, str(notebook_path.parent))
+
+    exporter, lock = _get_html_exporter()
+    with lock:
+        body, _ = exporter.from_notebook_node(notebook_node)
     return body
 
 
+# Rendered notebooks kept on disk; the oldest are purged beyond this count
+_NOTEBOOK_HTML_CACHE_MAX_FILES = 200
+
+
+def _notebook_html_cache_dir() -> Path:
+    # Private per-user folder: cached HTML is served straight into the page
+    cache_dir = Path.home() / ".cache" / "template_ui" / "nbconvert"
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return cache_dir
+
+
+def _purge_notebook_html_cache(cache_dir: Path) -> None:
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".html"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+    entries.sort(reverse=True)
+    for _, path in entries[_NOTEBOOK_HTML_CACHE_MAX_FILES:]:
+        Path(path).unlink(missing_ok=True)
+
+
 @st.cache_data(show_spinner=False)
 def _convert_notebook_to_html_cached(notebook_path_str: str, execute: bool, cache_key: str) -> str:
     # cache_key is used purely to invalidate the cache when file changes
-    return _convert_notebook_to_html(Path(notebook_path_str), execute)
+    # Rendered HTML is also kept on disk so it survives process restarts
+    cache_dir = _notebook_html_cache_dir()
+    cache_file = cache_dir / f"{cache_key}.html"
+    try:
+        return cache_file.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        pass
+    html = _convert_notebook_to_html(Path(notebook_path_str), execute)
+    # Unique temp file per writer, then an atomic rename into place
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir, suffix=".tmp", delete=False) as tmp:
+        tmp_path = tmp.name
+        try:
+            tmp.write(html)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    os.replace(tmp_path, cache_file)
+    _purge_notebook_html_cache(cache_dir)
+    return html
 
 
 def _ui_notebooks_tab() -> None:
@@ -271,12 +511,11 @@ def _ui_notebooks_tab() -> None:
         st.error(f"Dossier introuvable: {notebooks_dir}")
         return
 
-    notebooks = _list_notebooks(notebooks_dir)
-    if not notebooks:
+    options = _list_notebooks(notebooks_dir)
+    if not options:
         st.warning("Aucun notebook .ipynb trouvé.")
         return
 
-    options = [str(p.relative_to(notebooks_dir)) for p in notebooks]
     _preselected = st.session_state.get("nb_selected")
     _index = options.index(_preselected) if (_preselected in options) else 0
     selected = st.selectbox("Notebook", options, index=_index)
@@ -313,6 +552,7 @@ def _ui_notebooks_tab() -> None:
 
 def main() -> None:
     st.set_page_config(page_title="Générateur de templates", layout="wide")
+    _warm_templates()
     st.markdown(
         """
         <style>
@@ -331,7 +571,7 @@ def main() -> None:
         try:
             ndir = Path(st.session_state.get("nb_dir", nb_dir_default))
             if ndir.exists():
-                all_opts = [str(p.relative_to(ndir)) for p in _list_notebooks(ndir)]
+                all_opts = _list_notebooks(ndir)
                 q = str(st.session_state.get("nb_query", "")).lower()
                 options = [o for o in all_opts if q in o.lower()] if q else all_opts
         except Exception:
@@ -340,6 +580,8 @@ def main() -> None:
         st.checkbox("Exécuter avant rendu", value=st.session_state.get("nb_execute", False), key="nb_execute")
         if st.button("Afficher dans l'onglet"):
             st.session_state["nb_trigger_display"] = True
+        if st.button("Arrêter le kernel"):
+            _shutdown_kernels()
     tab_templates, tab_notebooks = st.tabs(["Templates", "Notebooks"])
     with tab_templates:
         _ui_templates_tab()